@@ -1,13 +1,37 @@
-import os, uvicorn, aiohttp, asyncio  # , ratelimitqueue
-from typing import Any, Optional, Tuple
+import os, time, string, hashlib, logging, orjson, uvicorn, aiohttp, asyncio  # , ratelimitqueue
+from contextlib import aclosing
+from typing import Any, AsyncIterator, Optional, Tuple
 from pydantic import BaseModel
-from fastapi import FastAPI, Response
-from rich.console import Console
+from fastapi import FastAPI, Request, Response
+from fastapi.responses import ORJSONResponse
 
 # --- Constants --- #
 
-app = FastAPI()
-console = Console()
+app = FastAPI(default_response_class=ORJSONResponse)
+# Shared across requests so connections are reused, created on startup
+app.state.session: aiohttp.ClientSession | None = None
+logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+logger = logging.getLogger("api")
+
+# Lowercased username -> (expiry as per time.monotonic, UUID or None if no account)
+uuid_cache: dict[str, Tuple[float, str | None]] = {}
+UUID_CACHE_TTL = 3600
+UUID_CACHE_NEGATIVE_TTL = 60  # Kept short so newly created accounts show up quickly
+UUID_CACHE_MAX_SIZE = 10_000
+
+# Caps concurrent requests to Mojang, bursts past this get ratelimited. The session's
+# connection pool is sized from this too, raising one without the other does nothing
+MOJANG_CONCURRENCY = 10
+mojang_semaphore = asyncio.Semaphore(MOJANG_CONCURRENCY)
+MAX_RETRIES = 3
+MAX_RETRY_DELAY = 5  # Seconds, client timeouts don't cover time spent waiting to retry
+
+ALLOWED_LETTERS = "abcdefghijklmnopqrstuvwxyz0123456789_"
+# Maps allowed bytes (either case) to 0 and everything else to 0xFF, for bytes.translate
+USERNAME_TABLE = bytes(
+    0 if chr(i) in ALLOWED_LETTERS + ALLOWED_LETTERS.upper() else 0xFF
+    for i in range(256)
+)
 # request_queue = ratelimitqueue.RateLimitQueue(calls=10, per=1)
 
 # --- Events --- #
@@ -15,13 +39,29 @@ console = Console()
 
 @app.on_event("startup")
 async def startup():
-    console.log("[API] Starting...")
-    console.rule("You can visit API documentation at http://localhost/redoc")
+    logger.info("[API] Starting...")
+    # Every request goes to api.mojang.com through mojang_semaphore, so the pool only
+    # needs as many connections as the semaphore lets through
+    connector = aiohttp.TCPConnector(
+        limit=MOJANG_CONCURRENCY,
+        limit_per_host=MOJANG_CONCURRENCY,
+        ttl_dns_cache=600,
+        enable_cleanup_closed=True,
+        keepalive_timeout=75,
+    )
+    app.state.session = aiohttp.ClientSession(
+        connector=connector,
+        timeout=aiohttp.ClientTimeout(total=5, connect=2),
+        headers={"User-Agent": "check_if_server_cracked/1.0"},
+    )
+    logger.info("[API] You can visit API documentation at http://localhost/redoc")
 
 
 @app.on_event("shutdown")
 async def shutdown():
-    console.log("[API] Shutting down...")
+    logger.info("[API] Shutting down...")
+    if app.state.session is not None:
+        await app.state.session.close()
 
 
 # --- Home --- #
@@ -32,95 +72,196 @@ class Player(BaseModel):
     name: str
 
 
+def get_retry_delay(response: aiohttp.ClientResponse, attempt: int) -> float:
+    """Returns how long to wait before retrying a ratelimited request, honouring Retry-After when it's sent, capped at MAX_RETRY_DELAY."""
+    try:
+        delay = float(response.headers["Retry-After"])
+    except (KeyError, ValueError):
+        delay = 0.5 * 2**attempt
+    # max() also turns negative or nan values into 0
+    return max(0.0, min(delay, MAX_RETRY_DELAY))
+
+
+async def request_mojang(
+    session: aiohttp.ClientSession, method: str, url: str, **kwargs: Any
+) -> Tuple[int, Any]:
+    """Sends a request to Mojang under mojang_semaphore, retrying ratelimited ones with backoff. Returns the final status code, and the JSON body if it's 200."""
+    for attempt in range(MAX_RETRIES + 1):
+        async with mojang_semaphore:
+            async with session.request(method, url, **kwargs) as response:
+                if response.status == 200:
+                    return response.status, await response.json()
+                elif response.status != 429 or attempt == MAX_RETRIES:
+                    return response.status, None
+                retry_delay = get_retry_delay(response, attempt)
+
+        # Sleeping outside of the semaphore lets other requests use the slot meanwhile
+        await asyncio.sleep(retry_delay)
+
+    return 429, None  # To appease type checker
+
+
 async def get_uuid(
-    username: str, rerunning: bool = False
+    username: str, session: aiohttp.ClientSession
 ) -> dict[str, bool | str | None]:
     """Returns the UUID of a player provided it's a premium player."""
-    to_return = {"status": None, "uuid": None, "username": username}
-    url = "https://api.mojang.com/users/profiles/minecraft/{}"
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url.format(username)) as response:
-            if response.status == 204:
-                to_return["status"] = False
-                return to_return
-            elif response.status == 200:
-                to_return["status"] = True
-                data = await response.json()
-                to_return["username"] = data["name"]
-                to_return["uuid"] = data["id"]
-                return to_return
-            elif response.status == 429:
-                to_return["status"] = False
-                if not rerunning:
-                    return to_return
-                # prevents query from being retried more than twice
-
-                await asyncio.sleep(0.5)
-                return await get_uuid(username, rerunning=True)
-
-            to_return["status"] = False
-            return to_return
-
-
-async def check_if_server_premium(players: list[dict[str, str]]) -> Tuple[bool, str | None, list]:  # type: ignore
-    """Given a dictionary of usernames to UUIDs, the function returns a boolean or Nonetype of whether or not the server is cracked based on whether or not the UUIDs match with the ones in mojang. To match with function name, response reversed.
+    to_return = {"status": False, "uuid": None, "username": username}
+    url = "https://api.mojang.com/users/profiles/minecraft/" + username
+    status, data = await request_mojang(session, "GET", url)
+    if status == 200:
+        to_return["status"] = True
+        to_return["username"] = data["name"]
+        to_return["uuid"] = data["id"]
+    return to_return
 
-    True, None: Server is premium
-    False, Reason: Server is cracked
-    """
-    allowed_letters = "abcdefghijklmnopqrstuvwxyz0123456789_"
+
+def cache_uuid(username: str, uuid: str | None) -> None:
+    """Stores a lookup result in uuid_cache, evicting the least recently used entry once it's full."""
+    ttl = UUID_CACHE_TTL if uuid is not None else UUID_CACHE_NEGATIVE_TTL
+    uuid_cache.pop(username, None)  # Re-inserting moves the entry to the back
+    uuid_cache[username] = (time.monotonic() + ttl, uuid)
+    if len(uuid_cache) > UUID_CACHE_MAX_SIZE:
+        del uuid_cache[next(iter(uuid_cache))]
+
+
+async def iter_uuids(
+    usernames: list[str], session: aiohttp.ClientSession
+) -> AsyncIterator[dict[str, str | None]]:
+    """Yields dictionaries of lowercased usernames to UUIDs as they're resolved, first from uuid_cache, then per batch of 10 through Mojang's bulk endpoint. Usernames without a premium account map to None or are missing. Closing the iterator early cancels the lookups still in flight."""
+    resolved: dict[str, str | None] = {}
+    to_fetch = []
+    now = time.monotonic()
+    for username in usernames:
+        # Popping drops expired entries, live ones are re-inserted as most recently used
+        cached = uuid_cache.pop(username.lower(), None)
+        if cached is not None and cached[0] > now:
+            uuid_cache[username.lower()] = cached
+            resolved[username.lower()] = cached[1]
+        else:
+            to_fetch.append(username)
+    if resolved:
+        yield resolved
+
+    chunks = [to_fetch[i : i + 10] for i in range(0, len(to_fetch), 10)]
+    tasks = [asyncio.create_task(get_uuid_batch(chunk, session)) for chunk in chunks]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            try:
+                fetched = await next_done
+            except Exception:
+                # A failed batch is left unresolved instead of failing the others
+                continue
+            for username, uuid in fetched.items():
+                cache_uuid(username, uuid)
+            yield fetched
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def get_uuid_batch(
+    usernames: list[str], session: aiohttp.ClientSession
+) -> dict[str, str | None]:
+    """Resolves up to 10 usernames with a single request, falling back to individual lookups if Mojang refuses the batch. Usernames confirmed to have no account map to None, failed lookups are left out."""
+    url = "https://api.mojang.com/profiles/minecraft"
+    status, data = await request_mojang(session, "POST", url, json=usernames)
+    if status == 200:
+        resolved: dict[str, str | None] = {
+            username.lower(): None for username in usernames
+        }
+        for profile in data:
+            resolved[profile["name"].lower()] = profile["id"]
+        return resolved
+    elif status == 429 or not 400 <= status < 500:
+        return {}  # Still ratelimited or a server error, left unresolved
+
+    # Mojang refused the payload itself, look usernames up one by one
+    gathered = await asyncio.gather(
+        *[get_uuid(username, session) for username in usernames],
+        return_exceptions=True,
+    )
+    return {
+        data["username"].lower(): data["uuid"]  # type: ignore
+        for data in gathered
+        if not isinstance(data, BaseException) and data["status"]
+    }
+
+
+def get_player_problem(player: Tuple[str, str]) -> str | None:
+    """Returns the reason a (username, unhyphenated UUID) pair can't belong to a premium account, or None if it looks valid."""
+    username, uuid = player
     min_length = 3
     max_length = 16
 
+    # If username length doesn't match allowed length
+    if not min_length <= len(username) <= max_length:
+        return "length"
+
+    # If any non allowed characters are used, non ascii characters are encoded as "?"
+    elif username.encode("ascii", "replace").translate(USERNAME_TABLE).strip(b"\x00"):
+        return "characters"
+
+    # If the UUID isn't 32 hex characters it can't match any account
+    elif len(uuid) != 32 or uuid.strip(string.hexdigits):
+        return "uuid"
+
+    return None
+
+
+def check_if_server_premium(players: list[Tuple[str, str]], resolved: dict[str, str | None]) -> Tuple[bool, str | None, list]:  # type: ignore
+    """Given a list of (username, UUID) tuples, the function returns a boolean or Nonetype of whether or not the server is cracked based on whether or not the UUIDs match with the ones in mojang. To match with function name, response reversed.
+
+    resolved maps the lowercased usernames being checked to their UUIDs, as yielded by iter_uuids.
+
+    True, None: Server is premium
+    False, Reason: Server is cracked
+    """
     if len(players) == 0:
         raise IndexError(
             "Players list must contain atleast on element."
         )  # To appease type checker
 
-    # Player = {"username": str, "uuid": unhyphenated uuid4}
+    # Player = (username, unhyphenated uuid4)
     for player in players:
-        username = player["username"]
+        username = player[0]
 
-        # If username length doesn't match allowed length
-        if len(username) > max_length:
-            return False, "length", players
-        elif len(username) < min_length:
-            return False, "length", players
+        problem = get_player_problem(player)
+        if problem is not None:
+            return False, problem, players
 
-        # If any non allowed characters are used
-        elif len(
-            [True for letter in set(username.lower()) if letter in allowed_letters]
-        ) != len(set(username.lower())):
-            return False, "characters", players
-        data = await get_uuid(username)
+        found_uuid = resolved.get(username.lower())
 
         # If getting the UUID fails, which can happen if theres no account with the username provided
-        if data["status"] == False:
+        if found_uuid is None:
             return False, "failed", players
 
         # If the UUID is different
-        found_uuid = data["uuid"]
-        if player["uuid"] != found_uuid:
+        if player[1] != found_uuid:
             return False, "different_uuid", players
 
-        return True, None, players
+    return True, None, players
 
 
 class Resp(BaseModel):
     status: bool
     message: Optional[str]
     premium: Optional[bool]
-    reasons: Optional[list[dict[str, dict[str, bool | str | None]]]]
+    reasons: Optional[dict[str, dict[str, bool | str | None]]]
 
 
 @app.post("/check_server", response_model=Resp)
-async def check_server(players: list[Player]) -> Response | dict[str, bool]:
+async def check_server(
+    players: list[Player], request: Request, response: Response, fail_fast: bool = False
+) -> Response | dict[str, bool]:
     # fmt: off
     """
     ## Checks if a server is premium, returns a dictionary.
 
     #### Args:  
     players (list[Player]): Use the value of the sample field on the ping response. Response['players']['sample'] -> that array is the input for this endpoint.
+    fail_fast (bool): Respond as soon as one player is found to be cracked, cancelling the remaining lookups. Reasons then only contain that player.
+
+    Responses where every lookup succeeded carry an ETag, send it back as If-None-Match to get a 304 instead of rechecking the same players. ETags change every minute.
 
     #### Returns:  
     - dict[str, str]: Error messages  
@@ -134,7 +275,7 @@ async def check_server(players: list[Player]) -> Response | dict[str, bool]:
 
             // Output
             {
-                "status": "err",
+                "status": false,
                 "message": "List must contain atleast one element."
             }                                           
 
@@ -152,55 +293,116 @@ async def check_server(players: list[Player]) -> Response | dict[str, bool]:
                 "status": true,
                 "message": null,
                 "premium": true,
-                "reasons": [{
+                "reasons": {
                     "thinkofdeath": {
                         "premium": true,
                         "reason": null
                     }
-                }]
+                }
             }
 
     """
     # fmt: on
-    data: list[dict[str, str]] = [player.dict() for player in players]
-
-    if len(data) == 0:
-        return Response(
-            content={
+    if len(players) == 0:
+        return ORJSONResponse(
+            {
                 "status": False,
                 "message": "List must contain atleast one element.",
             },
             status_code=422,
         )
 
-    to_check = [
-        {"username": player["name"], "uuid": player["id"].replace("-", "")}
-        for player in data
-    ]
-    to_check_2d = [[data] for data in to_check]
-    gathered = await asyncio.gather(
-        *[check_if_server_premium(to_check_q) for to_check_q in to_check_2d]
+    # Same players in any order give the same ETag, until the next minute starts so
+    # results such as a failed lookup aren't kept for longer than max-age
+    etag = '"{}"'.format(
+        hashlib.blake2b(
+            orjson.dumps(
+                [
+                    sorted((player.name, player.id) for player in players),
+                    fail_fast,
+                    int(time.time() // 60),
+                ]
+            ),
+            digest_size=16,
+        ).hexdigest()
+    )
+    if_none_match = request.headers.get("if-none-match", "")
+    if etag in [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]:
+        return Response(
+            status_code=304,
+            headers={"ETag": etag, "Cache-Control": "public, max-age=60"},
+        )
+
+    # Mojang returns lowercase, unhyphenated UUIDs
+    to_check = [(player.name, player.id.replace("-", "").lower()) for player in players]
+    if fail_fast:
+        for player in to_check:
+            if get_player_problem(player) is not None:
+                to_check = [player]  # No lookups needed, only this player is reported
+                break
+
+    # Only valid players are sent to Mojang, the bulk endpoint rejects the whole batch otherwise
+    # Usernames are case insensitive, so each one is only looked up once
+    usernames = list(
+        dict.fromkeys(
+            player[0].lower()
+            for player in to_check
+            if get_player_problem(player) is None
+        )
     )
-    to_return = {
+    resolved: dict[str, str | None] = {}
+    async with aclosing(iter_uuids(usernames, app.state.session)) as fetched_parts:
+        async for fetched in fetched_parts:
+            resolved.update(fetched)
+            if not fail_fast:
+                continue
+
+            cracked = [
+                player
+                for player in to_check
+                if player[0].lower() in fetched
+                and not check_if_server_premium([player], fetched)[0]
+            ]
+            if cracked:
+                to_check = cracked[:1]  # Only the first cracked player is reported
+                break
+
+    # Failed lookups (ratelimits, timeouts) are missing from resolved, a response
+    # containing them is only cacheable once Mojang answered for every reported player
+    if all(
+        player[0].lower() in resolved
+        for player in to_check
+        if get_player_problem(player) is None
+    ):
+        response.headers["ETag"] = etag
+        response.headers["Cache-Control"] = "public, max-age=60"
+
+    gathered = [check_if_server_premium([player], resolved) for player in to_check]
+    reasons: dict[str, dict[str, bool | str | None]] = {}
+    for g in gathered:
+        username = g[2][0][0]
+        # A duplicated username reports its first failing entry, or passes if all do
+        if username not in reasons or (reasons[username]["premium"] and not g[0]):
+            reasons[username] = {"premium": g[0], "reason": g[1]}
+    return {
         "status": True,
-        "reasons": [
-            {g[2][0]["username"]: {"premium": g[0], "reason": g[1]}} for g in gathered
-        ],
+        "premium": all(g[0] for g in gathered),
+        "reasons": reasons,
     }
-    reason_bools = [
-        bruh["premium"]
-        for bruh in [list(reason.values())[0] for reason in to_return["reasons"]]
-    ]
-    if False in reason_bools:
-        to_return["premium"] = False
-    else:
-        to_return["premium"] = True
-    return to_return
 
 
 # --- Running --- #
 
 if __name__ == "__main__":
+    # DEV reloads on code changes, which uvicorn only supports with a single worker
+    dev = bool(os.getenv("DEV"))
     uvicorn.run(
-        f"{os.path.basename(__file__).replace('.py', '')}:app", host="0.0.0.0", port=80
+        f"{os.path.basename(__file__).replace('.py', '')}:app",
+        host="0.0.0.0",
+        port=80,
+        workers=1 if dev else int(os.getenv("WORKERS", os.cpu_count() or 1)),
+        loop="uvloop",
+        http="httptools",
+        access_log=dev,
+        reload=dev,
     )
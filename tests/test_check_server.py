@@ -0,0 +1,276 @@
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+
+NOTCH = ("Notch", "069a79f444e94726a5befca90e38aaf5")
+JEB = ("jeb_", "853c80ef3c3749fdaa49938b674adae6")
+ACCOUNTS = {NOTCH[0].lower(): NOTCH, JEB[0].lower(): JEB}
+
+# Not used as a context manager, so startup doesn't replace the fake session
+client = TestClient(main.app)
+
+
+class FakeResponse:
+    def __init__(self, status: int, headers: dict[str, str] | None = None, data=None):
+        self.status = status
+        self.headers = headers or {}
+        self.data = data
+
+    async def json(self):
+        return self.data
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+
+class FakeSession:
+    """Stands in for the aiohttp session, answering Mojang's endpoints for Notch and jeb_. Queued (status, headers) pairs in statuses are answered first."""
+
+    def __init__(self):
+        self.statuses: list[tuple[int, dict[str, str]]] = []
+        self.posted: list[list[str]] = []
+        self.got: list[str] = []
+
+    def request(self, method, url, json=None):
+        if method == "POST":
+            self.posted.append(json)
+        else:
+            self.got.append(url.rsplit("/", 1)[1])
+        if self.statuses:
+            return FakeResponse(*self.statuses.pop(0))
+
+        if method == "POST":
+            profiles = [
+                {"name": ACCOUNTS[name.lower()][0], "id": ACCOUNTS[name.lower()][1]}
+                for name in json
+                if name.lower() in ACCOUNTS
+            ]
+            return FakeResponse(200, data=profiles)
+        elif self.got[-1].lower() not in ACCOUNTS:
+            return FakeResponse(204)
+        name, uuid = ACCOUNTS[self.got[-1].lower()]
+        return FakeResponse(200, data={"name": name, "id": uuid})
+
+
+@pytest.fixture
+def session(monkeypatch):
+    monkeypatch.setattr(main, "uuid_cache", {})
+    fake = FakeSession()
+    monkeypatch.setattr(main.app.state, "session", fake, raising=False)
+    return fake
+
+
+def check_server(players: list[tuple[str, str]], fail_fast: bool = False, **kwargs):
+    return client.post(
+        "/check_server",
+        params={"fail_fast": fail_fast},
+        json=[{"name": name, "id": uuid} for name, uuid in players],
+        **kwargs,
+    )
+
+
+def test_every_player_is_checked():
+    players = [NOTCH, (JEB[0], NOTCH[1])]
+    resolved = {NOTCH[0].lower(): NOTCH[1], JEB[0].lower(): JEB[1]}
+
+    assert main.check_if_server_premium(players, resolved)[:2] == (
+        False,
+        "different_uuid",
+    )
+
+
+def test_mismatched_second_player(session):
+    result = check_server([NOTCH, (JEB[0], NOTCH[1])]).json()
+
+    assert result["premium"] is False
+    assert result["reasons"][NOTCH[0]] == {"premium": True, "reason": None}
+    assert result["reasons"][JEB[0]] == {"premium": False, "reason": "different_uuid"}
+
+
+def test_premium_server(session):
+    response = check_server([NOTCH, JEB])
+
+    assert response.status_code == 200
+    assert response.json() == {
+        "status": True,
+        "message": None,
+        "premium": True,
+        "reasons": {
+            NOTCH[0]: {"premium": True, "reason": None},
+            JEB[0]: {"premium": True, "reason": None},
+        },
+    }
+    assert session.posted == [["notch", "jeb_"]]
+
+
+def test_empty_list(session):
+    response = check_server([])
+
+    assert response.status_code == 422
+    assert response.json()["status"] is False
+
+
+def test_matching_etag_returns_304(session):
+    etag = check_server([NOTCH, JEB]).headers["ETag"]
+    response = check_server([JEB, NOTCH], headers={"If-None-Match": etag})
+
+    assert response.status_code == 304
+    assert response.content == b""
+    assert len(session.posted) == 1
+
+
+def test_fail_fast_reports_first_cracked_player(session):
+    result = check_server([NOTCH, (JEB[0], NOTCH[1])], fail_fast=True).json()
+
+    assert result["premium"] is False
+    assert result["reasons"] == {JEB[0]: {"premium": False, "reason": "different_uuid"}}
+
+
+def test_fail_fast_skips_lookups_for_invalid_players(session):
+    result = check_server([NOTCH, ("a!", JEB[1])], fail_fast=True).json()
+
+    assert result["premium"] is False
+    assert result["reasons"] == {"a!": {"premium": False, "reason": "length"}}
+    assert session.posted == []
+
+
+def test_uppercase_hyphenated_uuid(session):
+    uuid = "-".join(["069A79F4", "44E9", "4726", "A5BE", "FCA90E38AAF5"])
+    result = check_server([(NOTCH[0], uuid)]).json()
+
+    assert result["premium"] is True
+
+
+@pytest.mark.parametrize("ids", [(NOTCH[1], "0" * 32), ("0" * 32, NOTCH[1])])
+def test_duplicate_username_keeps_failing_reason(session, ids):
+    result = check_server([(NOTCH[0], uuid) for uuid in ids]).json()
+
+    assert result["premium"] is False
+    assert result["reasons"] == {
+        NOTCH[0]: {"premium": False, "reason": "different_uuid"}
+    }
+
+
+def test_duplicate_username_reports_first_failure(session):
+    result = check_server([(NOTCH[0], "0" * 32), (NOTCH[0], "x")]).json()
+
+    assert result["reasons"] == {
+        NOTCH[0]: {"premium": False, "reason": "different_uuid"}
+    }
+
+
+def test_failed_lookup_is_not_cacheable(session):
+    session.statuses = [(503, {})]
+    response = check_server([NOTCH])
+
+    assert response.json()["reasons"][NOTCH[0]]["reason"] == "failed"
+    assert "ETag" not in response.headers
+    assert "Cache-Control" not in response.headers
+
+
+def test_missing_account_is_cacheable(session):
+    response = check_server([("nobody", NOTCH[1])])
+
+    assert response.json()["reasons"]["nobody"]["reason"] == "failed"
+    assert "ETag" in response.headers
+
+
+def test_ratelimited_batch_is_retried(session):
+    session.statuses = [(429, {"Retry-After": "0"})]
+    result = check_server([NOTCH]).json()
+
+    assert result["premium"] is True
+    assert session.posted == [["notch"], ["notch"]]
+    assert session.got == []
+
+
+def test_ratelimited_batch_gives_up_after_retries(session):
+    session.statuses = [(429, {"Retry-After": "0"})] * (main.MAX_RETRIES + 1)
+    result = check_server([NOTCH]).json()
+
+    assert result["reasons"][NOTCH[0]] == {"premium": False, "reason": "failed"}
+    assert len(session.posted) == main.MAX_RETRIES + 1
+    assert session.got == []
+
+
+def test_refused_batch_falls_back_to_individual_lookups(session):
+    session.statuses = [(400, {})]
+    result = check_server([NOTCH, JEB]).json()
+
+    assert result["premium"] is True
+    assert len(session.posted) == 1
+    assert sorted(session.got) == ["jeb_", "notch"]
+
+
+@pytest.mark.parametrize(
+    "headers, attempt, delay",
+    [
+        ({"Retry-After": "2"}, 0, 2),
+        ({"Retry-After": "20"}, 0, main.MAX_RETRY_DELAY),
+        ({"Retry-After": "-1"}, 0, 0),
+        ({"Retry-After": "nan"}, 0, 0),
+        ({}, 1, 1),
+        ({}, 10, main.MAX_RETRY_DELAY),
+    ],
+)
+def test_retry_delay(headers, attempt, delay):
+    assert main.get_retry_delay(FakeResponse(429, headers), attempt) == delay
+
+
+def test_ratelimited_individual_lookup_is_retried(session):
+    session.statuses = [(400, {}), (429, {"Retry-After": "0"})]
+    result = check_server([NOTCH]).json()
+
+    assert result["premium"] is True
+    assert session.got == ["notch", "notch"]
+
+
+def test_cached_username_is_not_looked_up_again(session):
+    check_server([NOTCH])
+    result = check_server([(NOTCH[0], "0" * 32)]).json()
+
+    assert result["reasons"][NOTCH[0]]["reason"] == "different_uuid"
+    assert session.posted == [["notch"]]
+
+
+def test_expired_cache_entry_is_dropped(session):
+    main.uuid_cache["notch"] = (main.time.monotonic() - 1, NOTCH[1])
+    result = check_server([NOTCH]).json()
+
+    assert result["premium"] is True
+    assert session.posted == [["notch"]]
+    assert main.uuid_cache["notch"][0] > main.time.monotonic()
+
+
+def test_missing_account_is_cached_briefly(session):
+    check_server([NOTCH, ("nobody", NOTCH[1])])
+    now = main.time.monotonic()
+
+    assert main.uuid_cache["nobody"][1] is None
+    assert main.uuid_cache["nobody"][0] - now <= main.UUID_CACHE_NEGATIVE_TTL
+    assert main.uuid_cache["notch"][0] - now > main.UUID_CACHE_NEGATIVE_TTL
+
+
+def test_cache_evicts_least_recently_used(session, monkeypatch):
+    monkeypatch.setattr(main, "UUID_CACHE_MAX_SIZE", 2)
+    check_server([NOTCH])
+    check_server([JEB])
+    check_server([NOTCH])  # Hit, Notch is now the most recently used
+    check_server([("nobody", NOTCH[1])])
+
+    assert list(main.uuid_cache) == ["notch", "nobody"]
+
+
+@pytest.mark.parametrize(
+    "uuid",
+    ["z" * 32, NOTCH[1][:-1], NOTCH[1] + "0", "069a79f4-44e9-4726-a5be-fca90e38aafg"],
+)
+def test_malformed_uuid_is_never_looked_up(session, uuid):
+    result = check_server([(NOTCH[0], uuid)]).json()
+
+    assert result["reasons"][NOTCH[0]] == {"premium": False, "reason": "uuid"}
+    assert session.posted == []